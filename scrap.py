@@ -1,32 +1,111 @@
 
 import requests
-from bs4 import BeautifulSoup
-from pytube import YouTube
-from moviepy.editor import VideoFileClip
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree
 import os
+import re
+import shutil
+import subprocess
+import threading
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Function to scrape songs from a playlist URL using BeautifulSoup
+# Shared HTTP session so repeated requests reuse pooled connections and retry transient failures
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+# (connect, read) timeout for every request
+REQUEST_TIMEOUT = (3.05, 30)
+
+# Audio is fetched in ranges of this size (pytube's default), retrying dropped connections
+RANGE_CHUNK_SIZE = 9 * 1024 * 1024
+STREAM_MAX_RETRIES = 3
+
+# Characters that are not allowed in file names on common filesystems
+_INVALID_FILENAME_CHARS = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Output formats: "mp3" always encodes, "native" saves YouTube's stream as-is,
+# "auto" rewraps AAC into .m4a when it is at least PASSTHROUGH_MIN_KBPS, else encodes to MP3
+OUTPUT_EXTENSIONS = {
+    'mp3': ('mp3',),
+    'native': ('mp4', 'webm'),  # Containers pytube serves audio-only streams in
+    'auto': ('m4a', 'mp3'),
+}
+PASSTHROUGH_MIN_KBPS = 128
+
+# ffmpeg output options for each way of writing a file
+MP3_ENCODE_ARGS = ['-c:a', 'libmp3lame', '-q:a', '0', '-f', 'mp3']
+M4A_COPY_ARGS = ['-c:a', 'copy', '-f', 'ipod']
+
+YOUTUBE_HOSTS = {'www.youtube.com', 'youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtu.be'}
+
+# Function to turn a song title into a safe file name
+def sanitize_filename(filename, max_bytes=240):
+    sanitized = filename.translate(_INVALID_FILENAME_CHARS)
+    sanitized = _WHITESPACE_RE.sub(' ', sanitized).strip()
+    # Filesystems cap names at 255 bytes, not characters; leave room for '.webm.part'
+    return sanitized.encode('utf-8')[:max_bytes].decode('utf-8', 'ignore').rstrip()
+
+# Function to pull finished elements off the parser, collecting song titles as they appear
+def _collect_songs(parser, songs):
+    for _, elem in parser.read_events():
+        if elem.tag == 'a' and elem.get('dir') == 'auto':
+            song_name = ''.join(elem.itertext()).strip()
+            if song_name:  # Skipping empty entries
+                songs.append(song_name)
+        elif next(elem.iterancestors('a'), None) is not None:
+            continue  # Still needed for the enclosing link's text
+        # Drop parsed content so the tree never holds the whole page
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+# Function to scrape songs from a playlist URL, parsing the page as it downloads
 def scrape_playlist(url):
+    songs = []
     try:
-        response = requests.get(url, verify=True)
-        response.raise_for_status()  # Raise an exception for bad status codes
+        with _session.get(url, verify=True, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()  # Raise an exception for bad status codes
+            # Feed raw bytes so lxml handles decoding in C. requests falls back to
+            # ISO-8859-1 for text/html without a charset, which would override the
+            # page's <meta charset>, so only pass an encoding the server declared
+            content_type = response.headers.get('Content-Type', '').lower()
+            encoding = response.encoding if 'charset=' in content_type else None
+            parser = etree.HTMLPullParser(events=('end',), encoding=encoding)
+            for chunk in response.iter_content(16384):
+                parser.feed(chunk)
+                _collect_songs(parser, songs)
+            parser.close()
+            _collect_songs(parser, songs)
     except requests.exceptions.RequestException as e:
         print(f"Error fetching playlist URL: {e}")
         return []
-
-    soup = BeautifulSoup(response.text, 'html.parser')
-    songs = []
-    for item in soup.find_all('a', {'dir': 'auto'}):
-        song_name = item.get_text().strip()
-        if song_name:  # Skipping empty entries
-            songs.append(song_name)
+    except etree.LxmlError as e:
+        # Empty or unparsable page
+        print(f"Error parsing playlist page: {e}")
+        return []
     return songs
 
 # Function to search for a song on YouTube using its title and return the video ID
 def search_youtube(query, api_key):
     try:
-        search_url = f"https://www.googleapis.com/youtube/v3/search?key={api_key}&q={query}&part=snippet&type=video"
-        response = requests.get(search_url, verify=True)
+        # Let requests encode the title, so '&', '#' and '+' stay part of the query.
+        # The key goes in a header to keep it out of URLs printed in error messages
+        response = _session.get(
+            "https://www.googleapis.com/youtube/v3/search",
+            params={'q': query, 'part': 'snippet', 'type': 'video'},
+            headers={'X-Goog-Api-Key': api_key},
+            verify=True,
+            timeout=REQUEST_TIMEOUT,
+        )
         response.raise_for_status()  # Raise an exception for bad status codes
     except requests.exceptions.RequestException as e:
         print(f"Error searching for '{query}' on YouTube: {e}")
@@ -40,46 +119,200 @@ def search_youtube(query, api_key):
         print(f"No results found for '{query}' on YouTube")
         return None
 
-# Function to download audio from a YouTube video using its video ID
-def download_audio(video_id, output_file):
+# Function to list a YouTube video's audio-only streams, highest bitrate first
+def _audio_streams(video_id):
+    from pytube import YouTube
+
+    yt = YouTube(f"https://www.youtube.com/watch?v={video_id}")
+    return yt.streams.filter(only_audio=True).order_by('abr').desc()
+
+# Function to read a stream's bitrate in kbps, e.g. '128kbps' -> 128
+def _abr_kbps(audio_stream):
+    try:
+        return int(audio_stream.abr.rstrip('kbps'))
+    except (AttributeError, ValueError):
+        return 0
+
+# Function to copy a stream's bytes into a writable file object over the shared session
+def _fetch_stream(audio_stream, out):
+    # Ask for the body in &range= chunks like pytube does: googlevideo throttles long
+    # single transfers, and a dropped connection resumes from the last byte received
+    total = audio_stream.filesize
+    downloaded = 0
+    failures = 0
+    while downloaded < total:
+        start = downloaded
+        stop = min(start + RANGE_CHUNK_SIZE, total) - 1
+        try:
+            with _session.get(f"{audio_stream.url}&range={start}-{stop}", stream=True, timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(64 * 1024):
+                    out.write(chunk)
+                    downloaded += len(chunk)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            failures += 1
+            if failures > STREAM_MAX_RETRIES:
+                raise
+            continue
+        if downloaded == start:
+            raise IOError(f"No data received for bytes {start}-{stop}")
+
+# Function to save a stream's bytes unchanged to audio_file
+def _save_stream(audio_stream, audio_file):
+    # Write to a .part file so an interrupted download never looks finished
+    part_file = audio_file + '.part'
     try:
-        yt = YouTube(f"https://www.youtube.com/watch?v={video_id}")
-        audio_stream = yt.streams.filter(only_audio=True).first()
-        if audio_stream:
-            audio_stream.download(output_file=output_file)
+        with open(part_file, 'wb') as out:
+            _fetch_stream(audio_stream, out)
+    except Exception:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+    os.replace(part_file, audio_file)
+
+# Function to stream audio straight into ffmpeg and write out_file with the given output options
+def _pipe_to_ffmpeg(audio_stream, out_file, output_args):
+    # ffmpeg writes to a .part file that only replaces out_file once it is complete
+    part_file = out_file + '.part'
+    try:
+        proc = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error', '-y', '-i', 'pipe:0', '-vn', *output_args, part_file],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+    except OSError as e:
+        print(f"Error starting ffmpeg for {out_file}: {e}")
+        return False
+
+    # Feed ffmpeg from a second thread while this one drains stderr,
+    # otherwise a full stderr pipe could stall both processes
+    feed_errors = []
+
+    def feed():
+        try:
+            _fetch_stream(audio_stream, proc.stdin)
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    stderr = proc.stderr.read()
+    proc.wait()
+    writer.join()
+
+    if feed_errors or proc.returncode != 0:
+        # A cut-off download still yields a playable but truncated file, so discard it
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        # If ffmpeg gave up, the writer's BrokenPipeError is only a symptom of that
+        if proc.returncode != 0:
+            print(f"Error writing {out_file}: {stderr.decode(errors='replace').strip()}")
         else:
+            print(f"Error downloading audio for {out_file}: {feed_errors[0]}")
+        return False
+    os.replace(part_file, out_file)
+    return True
+
+# Function to download a YouTube video's audio in the requested output format and return its path
+def download_audio(video_id, output_dir, filename, output_format="mp3"):
+    try:
+        streams = _audio_streams(video_id)
+        audio_stream = streams.first()
+        if audio_stream is None:
             print(f"No audio stream found for video ID {video_id}")
+            return None
+        base = os.path.join(output_dir, filename)
+
+        if output_format == "native":
+            # Keep the stream's own container (mp4/webm), there is no video to strip
+            audio_file = f"{base}.{audio_stream.subtype}"
+            _save_stream(audio_stream, audio_file)
+            return audio_file
+
+        if output_format == "auto":
+            # A good-enough AAC stream gains nothing from an MP3 re-encode, so just rewrap it
+            aac_stream = streams.filter(subtype='mp4').first()
+            if aac_stream is not None and _abr_kbps(aac_stream) >= PASSTHROUGH_MIN_KBPS:
+                audio_file = f"{base}.m4a"
+                if _pipe_to_ffmpeg(aac_stream, audio_file, M4A_COPY_ARGS):
+                    return audio_file
+                # Anything that can't be rewrapped is encoded to MP3 instead
+                print(f"Falling back to MP3 for video ID {video_id}")
+
+        audio_file = f"{base}.mp3"
+        return audio_file if _pipe_to_ffmpeg(audio_stream, audio_file, MP3_ENCODE_ARGS) else None
     except Exception as e:
         print(f"Error downloading audio for video ID {video_id}: {e}")
+    return None
 
-# Function to separate audio from an MP4 file and delete the MP4
-def separate_audio(mp4_file, mp3_file):
-    try:
-        video = VideoFileClip(mp4_file)
-        video.audio.write_audiofile(mp3_file)
-        video.close()  # Close the video file
-        os.remove(mp4_file)  # Delete the MP4 file
-    except Exception as e:
-        print(f"Error separating audio from {mp4_file}: {e}")
+# Function to cheaply check that a URL points at a YouTube playlist
+def _validate_playlist_url(url):
+    parsed = urlparse(url)
+    return parsed.hostname in YOUTUBE_HOSTS and 'list' in parse_qs(parsed.query)
+
+# Function to search and download a single song
+def process_song(song, api_key, output_dir=".", output_format="mp3", existing=frozenset()):
+    filename = sanitize_filename(song)
+    # Skip songs saved by an earlier run before spending any API quota on them
+    if any(f"{filename}.{ext}" in existing for ext in OUTPUT_EXTENSIONS[output_format]):
+        print(f"Audio for '{song}' already exists, skipping.")
+        return
+
+    print(f"Searching for '{song}' on YouTube...")
+    video_id = search_youtube(song, api_key)
+    if video_id:
+        print(f"Downloading audio for '{song}'...")
+        audio_file = download_audio(video_id, output_dir, filename, output_format)
+        if not audio_file:
+            return
+        print(f"Audio for '{song}' has been downloaded successfully!")
 
 # Main function
 def main():
     playlist_url = "YOUR_PLAYLIST_URL_HERE"
     api_key = "YOUR_YOUTUBE_API_KEY_HERE"
+    output_dir = "."
+    output_format = "mp3"  # "mp3", "native" (no transcode) or "auto", see OUTPUT_EXTENSIONS
+    max_workers = 8
+
+    # Reject bad input before doing any network or conversion work
+    if output_format not in OUTPUT_EXTENSIONS:
+        print(f"Unknown output format: {output_format}")
+        return
+    if not _validate_playlist_url(playlist_url):
+        print(f"Not a YouTube playlist URL: {playlist_url}")
+        return
+
+    # Check for ffmpeg up front instead of failing on every song
+    if output_format != "native" and shutil.which("ffmpeg") is None:
+        print("ffmpeg was not found on PATH; install it or set output_format = \"native\"")
+        return
+
+    # Drop titles that map to the same file name so two workers never write the same file
+    unique_songs = {}
+    for song in scrape_playlist(playlist_url):
+        unique_songs.setdefault(sanitize_filename(song), song)
+    songs = list(unique_songs.values())
+    if not songs:
+        return
+
+    # One directory read instead of a stat call per song. Read-only from here on:
+    # songs were de-duplicated by file name above, so no two workers share an output
+    os.makedirs(output_dir, exist_ok=True)
+    existing = frozenset(entry.name for entry in os.scandir(output_dir))
 
-    songs = scrape_playlist(playlist_url)
-
-    for song in songs:
-        print(f"Searching for '{song}' on YouTube...")
-        video_id = search_youtube(song, api_key)
-        if video_id:
-            print(f"Downloading audio for '{song}'...")
-            mp4_file = f"temp_{song}.mp4"
-            download_audio(video_id, mp4_file)
-            mp3_file = f"{song}.mp3"
-            print(f"Separating audio from '{song}'...")
-            separate_audio(mp4_file, mp3_file)
-            print(f"Audio for '{song}' has been downloaded and separated successfully!")
+    # Songs are independent and mostly wait on the network, so overlap them
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(songs))) as executor:
+        futures = {executor.submit(process_song, song, api_key, output_dir, output_format, existing): song for song in songs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing '{futures[future]}': {e}")
 
 if __name__ == "__main__":
     main()